@@ -1,33 +1,62 @@
+import bisect
+import copy
 import os
 import re
 import logging
 import asyncio
-import tempfile
-import traceback
+import queue
+import atexit
+import logging.handlers
 import datetime
 import time
+import hashlib
+import functools
+import threading
+import concurrent.futures
 import httpx
-import json
-from contextlib import asynccontextmanager
-from aiogram import Bot, Dispatcher, F, types
+import orjson
+import msgpack
+from contextlib import asynccontextmanager, nullcontext
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StateType, StorageKey
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.enums import ParseMode, ChatAction
-from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from openai import AsyncOpenAI
+from aiogram.types import Message, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
 from dotenv import load_dotenv
-from docx import Document
+from utils.docgen import generate_doc_from_text
+from utils.gpt import close_client as close_gpt_client
 from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from natasha import Doc, Segmenter, NewsEmbedding, NewsNERTagger
 import cachetools
 from jinja2 import Template
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен на Windows
+    uvloop = None
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+# Настройка логирования: обработчики пишут в поток из фонового потока,
+# чтобы медленный stderr (journald, docker) не блокировал event loop
+def _setup_logging() -> logging.handlers.QueueListener:
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+_log_listener = _setup_logging()
 logger = logging.getLogger(__name__)
 
 # Загрузка переменных окружения
@@ -144,29 +173,380 @@ TEMPLATE_TERMINATION_NOTICE = """
 ___________________ {{ sender.name }}
 """
 
+# Переменные, которые всегда запрашиваются для договора аренды
+STANDARD_VARS = ("АДРЕС_ОБЪЕКТА", "ПЛОЩАДЬ", "КАДАСТРОВЫЙ_НОМЕР", "АРЕНДНАЯ_ПЛАТА", 
+                 "СРОК_АРЕНДЫ", "ДАТА_НАЧАЛА", "ДАТА_ОКОНЧАНИЯ", "СТАВКА_НДС", 
+                 "ДЕПОЗИТ", "КОММУНАЛЬНЫЕ_ПЛАТЕЖИ")
+
+# Предкомпилированные регулярные выражения
+DATE_RE = re.compile(r'\A\d{2}\.\d{2}\.\d{4}\Z')
+
+# Telegram показывает chat action около 5 секунд, поэтому повторяем чуть раньше
+CHAT_ACTION_INTERVAL = 4.9
+# Быстрые операции завершаются раньше этой задержки и не тратят запрос к Telegram
+CHAT_ACTION_DELAY = 0.3
+
+_ASCII_DIGITS = b"0123456789"
+
+def _is_ascii_digits(value: str, lengths: tuple = None) -> bool:
+    """Проверяет, что строка состоит только из цифр 0-9 (без Unicode-цифр вроде ²)"""
+    if not value or not value.isascii():
+        return False
+    if lengths is not None and len(value) not in lengths:
+        return False
+    # translate удаляет все цифры на уровне C; непустой остаток означает другие символы
+    return not value.encode("ascii").translate(None, _ASCII_DIGITS)
+
+# Время жизни кэша ответов OpenAI (сутки)
+GPT_CACHE_TTL = 24 * 3600
+# Параметры запросов к OpenAI по умолчанию
+GPT_MODEL = "gpt-3.5-turbo-0125"
+GPT_TEMPERATURE = 0.2
+GPT_MAX_TOKENS = 3000
+
 # Валидаторы для полей
 VALIDATORS = {
-    "ИНН": lambda x: x.isdigit() and len(x) in (10, 12),
-    "ДАТА": lambda x: re.match(r'\d{2}\.\d{2}\.\d{4}', x),
-    "ПЛОЩАДЬ": lambda x: x.isdigit(),
-    "АРЕНДНАЯ_ПЛАТА": lambda x: x.isdigit(),
-    "ДЕПОЗИТ": lambda x: x.isdigit()
+    "ИНН": lambda x: _is_ascii_digits(x, (10, 12)),
+    "ДАТА": lambda x: DATE_RE.match(x),
+    "ПЛОЩАДЬ": _is_ascii_digits,
+    "АРЕНДНАЯ_ПЛАТА": _is_ascii_digits,
+    "ДЕПОЗИТ": _is_ascii_digits
+}
+
+# Переменные, которые всегда запрашиваются для договора аренды
+RENT_SPECIFIC_VARS = (
+    "АДРЕС_ОБЪЕКТА", "ПЛОЩАДЬ", "КАДАСТРОВЫЙ_НОМЕР",
+    "АРЕНДНАЯ_ПЛАТА", "СРОК_АРЕНДЫ", "ДАТА_НАЧАЛА",
+    "ДАТА_ОКОНЧАНИЯ", "СТАвКА_НДС", "ДЕПОЗИТ",
+    "КОММУНАЛЬНЫЕ_ПЛАТЕЖИ", "ПОРЯДОК_ОПЛАТЫ"
+)
+# Время жизни кэша плана опроса переменных (сутки)
+VAR_PLAN_TTL = 24 * 3600
+
+# Параметры аренды из GPT, которыми предзаполняются переменные договора
+RENTAL_PARAM_VARS = (
+    ("area", "ПЛОЩАДЬ"),
+    ("address", "АДРЕС_ОБЪЕКТА"),
+    ("deposit", "ДЕПОЗИТ"),
+    ("utilities", "КОММУНАЛЬНЫЕ_ПЛАТЕЖИ"),
+)
+
+# Ключевые слова типа бизнеса и аренды: текст сканируется одним регулярным выражением
+BUSINESS_RE = re.compile(
+    r"(?P<cafe>кафе|кофейн|ресторан|столов|бар)"
+    r"|(?P<shop>магазин|торгов|рознич|бутик)"
+    r"|(?P<beauty>салон красот|парикмахер|ногтев|косметолог)"
+    r"|(?P<rental>аренд|съем|помещен|площад|офис|салон)",
+    re.IGNORECASE
+)
+# Совпадения, по которым запрос относится к аренде (кафе/магазин/салон тоже считаются)
+RENTAL_PREFIXES = ("аренд", "съем", "помещен", "площад", "офис", "магазин", "кафе", "салон")
+BUSINESS_PRIORITY = ("cafe", "shop", "beauty")
+
+# Ключевые слова ролей сторон и шаблоны извлечения имени после них
+LANDLORD_KEYWORDS = ("арендодатель", "собственник", "лизингодатель", "арендодателя", "owner", "lessor")
+TENANT_KEYWORDS = ("арендатор", "наниматель", "лизингополучатель", "арендатора", "tenant", "lessee")
+LANDLORD_PATTERNS = tuple(
+    (kw, re.compile(fr"{kw}[:\-—\s]*(.+?)(?:{TENANT_KEYWORDS[0]}|$)")) for kw in LANDLORD_KEYWORDS
+)
+TENANT_PATTERNS = tuple((kw, re.compile(fr"{kw}[:\-—\s]*(.+)")) for kw in TENANT_KEYWORDS)
+WHITESPACE_RE = re.compile(r'\s+')
+PARTIES_SPLIT_RE = re.compile(r'[,;и]| арендодатель | арендатор ', re.IGNORECASE)
+
+# Юридические формы лиц (порядок задает приоритет)
+LEGAL_FORMS = {
+    "ип": "ИП",
+    "индивидуальный предприниматель": "ИП",
+    "ооо": "ООО",
+    "общество с ограниченной ответственностью": "ООО",
+    "ао": "АО",
+    "оао": "АО",
+    "зао": "АО",
+    "пао": "АО",
+    "акционерное общество": "АО",
+    "публичное акционерное общество": "АО",
+    "закрытое акционерное общество": "АО",
+    "нко": "НКО",
+    "некоммерческая организация": "НКО",
+    "пк": "ПК",
+    "производственный кооператив": "ПК",
+    "кфх": "КФХ",
+    "крестьянское фермерское хозяйство": "КФХ",
+    "тсн": "ТСН",
+    "товарищество собственников недвижимости": "ТСН",
+    "потребительский кооператив": "ПК",
+    "адвокатское образование": "АО",
+    "адвокатское бюро": "АО",
+    "коллегия адвокатов": "КА",
+    "юридическая компания": "ЮК",
+    "юридическое лицо": "ЮЛ",
 }
+# Все формы одной альтернативой (длинные первыми); при нескольких совпадениях
+# побеждает форма, стоящая раньше в LEGAL_FORMS
+LEGAL_FORMS_RE = re.compile(
+    r"\b(" + "|".join(re.escape(p) for p in sorted(LEGAL_FORMS, key=len, reverse=True)) + r")\b"
+)
+LEGAL_FORM_PRIORITY = {pattern: i for i, pattern in enumerate(LEGAL_FORMS)}
+PERSON_MARKERS_RE = re.compile(r"\bфл\b|\bфиз\b|\bгражданин\b|\bг-н\b|\bфизлицо\b")
+PERSON_NAME_RE = re.compile(r"\b[а-яё]+\s+[а-яё][.\s]*[а-яё]?[.\s]*[а-яё]?[.]?\b")
+PERSON_INITIALS_RE = re.compile(r"[А-ЯЁ]\.[\s]*[А-ЯЁ]\.[\s]*[А-ЯЁ][а-яё]+")
+INN_RE = re.compile(r"\b\d{10,12}\b")
+AREA_RE = re.compile(r'(\d+)\s*(м²|м2|кв\.?м|кв|м\s*кв)')
+PLACEHOLDER_RE = re.compile(r'\[(.*?)\]')
+
+# Числительные для сумм прописью
+_UNITS = ['', 'один', 'два', 'три', 'четыре', 'пять', 'шесть', 'семь', 'восемь', 'девять']
+_TEENS = ['десять', 'одиннадцать', 'двенадцать', 'тринадцать', 'четырнадцать', 'пятнадцать', 
+          'шестнадцать', 'семнадцать', 'восемнадцать', 'девятнадцать']
+_TENS = ['', '', 'двадцать', 'тридцать', 'сорок', 'пятьдесят', 
+         'шестьдесят', 'семьдесят', 'восемьдесят', 'девяносто']
+_HUNDREDS = ['', 'сто', 'двести', 'триста', 'четыреста', 'пятьсот', 
+             'шестьсот', 'семьсот', 'восемьсот', 'девятьсот']
+
+def _convert_hundreds(n: int) -> str:
+    if n < 10:
+        return _UNITS[n]
+    elif 10 <= n < 20:
+        return _TEENS[n-10]
+    elif 20 <= n < 100:
+        return _TENS[n//10] + (' ' + _UNITS[n%10] if n%10 != 0 else '')
+    return _HUNDREDS[n//100] + (' ' + _convert_hundreds(n%100) if n%100 != 0 else '')
+
+def _feminine(words: str) -> str:
+    head, _, last = words.rpartition(' ')
+    last = {'один': 'одна', 'два': 'две'}.get(last, last)
+    return f"{head} {last}" if head else last
+
+def _plural(n: int, one: str, few: str, many: str) -> str:
+    if 11 <= n % 100 <= 14:
+        return many
+    if n % 10 == 1:
+        return one
+    if 2 <= n % 10 <= 4:
+        return few
+    return many
+
+# Прописи для 0–999 вычисляются один раз, дальше число собирается из групп по три цифры
+NUM_WORDS = tuple(_convert_hundreds(i) for i in range(1000))
+NUM_WORDS_FEMININE = tuple(_feminine(words) for words in NUM_WORDS)
+NUM_SCALES = (
+    (10 ** 9, ('миллиард', 'миллиарда', 'миллиардов'), False),
+    (10 ** 6, ('миллион', 'миллиона', 'миллионов'), False),
+    (10 ** 3, ('тысяча', 'тысячи', 'тысяч'), True),
+)
+
+def _num_to_words(num: int) -> str:
+    """Число прописью (до триллиона)"""
+    if num == 0:
+        return "ноль"
+    if num >= 10 ** 12:
+        return str(num)
+    
+    parts = []
+    for scale, forms, feminine in NUM_SCALES:
+        group, num = divmod(num, scale)
+        if group:
+            words = NUM_WORDS_FEMININE[group] if feminine else NUM_WORDS[group]
+            parts.append(f"{words} {_plural(group, *forms)}")
+    if num:
+        parts.append(NUM_WORDS[num])
+    return " ".join(parts)
+
+# Суммы аренды повторяются (круглые значения), поэтому строка кэшируется
+@functools.lru_cache(maxsize=2048)
+def _amount_words(amount: int) -> str:
+    """Сумма цифрами и прописью для [АРЕНДНАЯ_ПЛАТА_ПРОПИСЬЮ]"""
+    return f"{amount} ({_num_to_words(amount)}) рублей"
+
+def _field_roles(role_info: dict) -> dict:
+    """Словарь поле -> роль (при повторе поля побеждает первая роль)"""
+    field_roles = {}
+    for role_name, role_data in role_info.get("roles", {}).items():
+        for field in role_data.get("fields", []):
+            field_roles.setdefault(field, role_name)
+    return field_roles
+
+def _extract_json_span(text: str):
+    """Возвращает первый сбалансированный JSON-объект из ответа GPT (или None)"""
+    start = text.find("{")
+    if start == -1:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+class PipelinedRedisStorage(RedisStorage):
+    """RedisStorage, записывающий состояние и данные за один round trip"""
+
+    async def set_state_and_data(self, key: StorageKey, state: StateType = None, data: dict = None):
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if state is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(state_key, state.state if isinstance(state, State) else state, ex=self.state_ttl)
+            if data:
+                pipe.set(data_key, self._encode_data(data), ex=self.data_ttl)
+            else:
+                pipe.delete(data_key)
+            await pipe.execute()
+
+    def _encode_data(self, data: dict):
+        return self.json_dumps(data)
+
+class MsgpackRedisStorage(PipelinedRedisStorage):
+    """Хранит данные FSM в msgpack: меньше объем и нет декодирования строк на чтении"""
+
+    def _encode_data(self, data: dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    async def set_data(self, key: StorageKey, data: dict):
+        data_key = self.key_builder.build(key, "data")
+        if not data:
+            await self.redis.delete(data_key)
+            return
+        await self.redis.set(data_key, self._encode_data(data), ex=self.data_ttl)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        value = await self.redis.get(self.key_builder.build(key, "data"))
+        if value is None:
+            return {}
+        # Данные, записанные прежней JSON-версией хранилища: карта msgpack не начинается с "{"
+        if value[:1] == b"{":
+            return self.json_loads(value)
+        return msgpack.unpackb(value, raw=False)
+
+class CachedFSMContext(FSMContext):
+    """FSM-контекст, который читает данные один раз за апдейт и откладывает запись до его конца"""
+
+    def __init__(self, storage, key: StorageKey):
+        super().__init__(storage=storage, key=key)
+        self._data = None
+        self._state = None
+        self._data_dirty = False
+        self._state_dirty = False
+
+    async def get_state(self):
+        if self._state_dirty:
+            return self._state
+        return await super().get_state()
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    # Глубокие копии: изменение вложенных значений (например, filled_variables)
+    # без set_data/update_data не должно менять данные, которые будут записаны
+    async def get_data(self) -> dict:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return copy.deepcopy(self._data)
+
+    async def set_data(self, data: dict) -> None:
+        self._data = copy.deepcopy(data)
+        self._data_dirty = True
+
+    async def update_data(self, data: dict = None, **kwargs) -> dict:
+        current = await self.get_data()
+        if data:
+            current.update(data)
+        current.update(kwargs)
+        await self.set_data(current)
+        return current
+
+    async def set_state_and_data(self, state: StateType = None, data: dict = None) -> None:
+        await self.set_state(state)
+        await self.set_data(data or {})
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения одним обращением к хранилищу"""
+        if self._state_dirty and self._data_dirty:
+            await self.storage.set_state_and_data(self.key, self._state, self._data)
+        elif self._state_dirty:
+            await self.storage.set_state(key=self.key, state=self._state)
+        elif self._data_dirty:
+            await self.storage.set_data(key=self.key, data=self._data)
+        self._state_dirty = self._data_dirty = False
+
+class FSMCacheMiddleware(BaseMiddleware):
+    """Подменяет FSM-контекст кэширующим и сохраняет его изменения в конце апдейта"""
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        if state is None:
+            return await handler(event, data)
+        
+        cached = CachedFSMContext(state.storage, state.key)
+        data["state"] = cached
+        try:
+            return await handler(event, data)
+        finally:
+            # Ошибка записи не должна подменять исключение самого обработчика
+            try:
+                await cached.flush()
+            except Exception as e:
+                logger.error("Ошибка сохранения состояния FSM: %s", e)
 
 class BotApplication:
+    # Модели Natasha общие для всех экземпляров и загружаются один раз
+    _shared_segmenter = None
+    _shared_emb = None
+    _shared_ner_tagger = None
+    _models_lock = threading.Lock()
+
+    @classmethod
+    def preload_models(cls):
+        """Загружает модели Natasha на уровне класса (можно вызвать до fork рабочих процессов)"""
+        if cls._shared_ner_tagger is not None:
+            return
+        with cls._models_lock:
+            # Повторная проверка: модели могли загрузиться в другом потоке
+            if cls._shared_ner_tagger is None:
+                cls._shared_segmenter = Segmenter()
+                cls._shared_emb = NewsEmbedding()
+                cls._shared_ner_tagger = NewsNERTagger(cls._shared_emb)
+
     def __init__(self):
         self.bot = None
         self.dp = None
         self.redis = None
         self.openai_client = None
+        self._http = None
         self.states = None
         self.progress_tasks = {}  # Для отслеживания задач прогресса
+        self._active_actions = {}  # chat_id -> стек активных chat action
+        self._action_deadlines = {}  # chat_id -> время следующей отправки chat action
+        self._action_wakeup = None
+        self._action_pump_task = None
+        self._inflight = {}  # Выполняющиеся запросы к OpenAI по ключу параметров
         
-        # Инициализация компонентов Natasha с кэшированием
-        self.segmenter = Segmenter()
-        self.emb = NewsEmbedding()
-        self.ner_tagger = NewsNERTagger(self.emb)
+        # Компоненты Natasha загружаются в initialize()
+        self.segmenter = None
+        self.emb = None
+        self.ner_tagger = None
         self.ner_cache = cachetools.LRUCache(maxsize=1000)
+        self._ner_executor = None
+        self._docx_executor = None
 
     async def initialize(self):
         os.environ.pop("HTTP_PROXY", None)
@@ -183,16 +563,37 @@ class BotApplication:
                 "BOT_TOKEN, OPENAI_API_KEY, REDIS_URL"
             )
 
+        # Общий HTTP/2-клиент: параллельные запросы мультиплексируются в одном соединении
+        self._http = httpx.AsyncClient(
+            proxies=None,
+            http2=True,
+            timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0),
+            limits=httpx.Limits(
+                max_connections=50,
+                max_keepalive_connections=50,
+                keepalive_expiry=60.0
+            )
+        )
+        # Повторы выполняются в _request_completion, поэтому встроенные повторы SDK отключены
         self.openai_client = AsyncOpenAI(
             api_key=OPENAI_API_KEY,
-            http_client=httpx.AsyncClient(
-                proxies=None,
-                timeout=30.0,
-                limits=httpx.Limits(
-                    max_connections=10,
-                    max_keepalive_connections=2
-                )
-            )
+            max_retries=0,
+            http_client=self._http
+        )
+
+        # Загрузка весов занимает заметное время, поэтому выполняется в потоке
+        await asyncio.to_thread(self.preload_models)
+        self.segmenter = self._shared_segmenter
+        self.emb = self._shared_emb
+        self.ner_tagger = self._shared_ner_tagger
+
+        self._ner_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2,
+            thread_name_prefix="ner"
+        )
+        self._docx_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4,
+            thread_name_prefix="docx"
         )
 
         self.redis = Redis.from_url(
@@ -200,16 +601,30 @@ class BotApplication:
             socket_timeout=10,
             socket_connect_timeout=5,
             retry_on_timeout=True,
-            decode_responses=True,
+            decode_responses=False,
             health_check_interval=30
         )
         
         if not await self.redis.ping():
             raise ConnectionError("Не удалось подключиться к Redis")
 
-        storage = RedisStorage(redis=self.redis)
-        self.bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
+        storage = MsgpackRedisStorage(
+            redis=self.redis,
+            json_loads=orjson.loads,
+            json_dumps=orjson.dumps
+        )
+        # orjson для (де)сериализации запросов и ответов Bot API
+        session = AiohttpSession(
+            json_loads=orjson.loads,
+            json_dumps=lambda value: orjson.dumps(value).decode()
+        )
+        self.bot = Bot(token=BOT_TOKEN, session=session, parse_mode=ParseMode.HTML)
         self.dp = Dispatcher(storage=storage)
+        # Одно чтение и одна запись данных FSM в Redis на апдейт
+        self.dp.update.middleware(FSMCacheMiddleware())
+        
+        self._action_wakeup = asyncio.Event()
+        self._action_pump_task = asyncio.create_task(self._action_pump())
 
         class DocGenState(StatesGroup):
             initial_input = State()
@@ -331,66 +746,75 @@ class BotApplication:
         empty = '▁' * (length - filled_length)
         return filled + empty
 
-    def extract_entities(self, text: str) -> dict:
+    async def _cached(self, namespace: str, key_text: str, factory, ttl: int = 3600):
+        """Кэширует в Redis результат корутины по blake2b-хэшу входного текста"""
+        key = f"cache:{namespace}:{hashlib.blake2b(key_text.encode(), digest_size=16).hexdigest()}"
+        try:
+            cached = await self.redis.get(key)
+        except RedisError as e:
+            logger.warning("Ошибка чтения кэша %s: %s", namespace, e)
+            cached = None
+        if cached is not None:
+            return orjson.loads(cached)
+        
+        result = await factory()
+        try:
+            await self.redis.set(key, orjson.dumps(result), ex=ttl)
+        except RedisError as e:
+            logger.warning("Ошибка записи кэша %s: %s", namespace, e)
+        return result
+
+    async def extract_entities(self, text: str) -> dict:
         """Извлекает сущности с кэшированием"""
         if text in self.ner_cache:
             return self.ner_cache[text]
         
+        result = await self._cached("ner", text, lambda: self._run_ner(text))
+        self.ner_cache[text] = result
+        return result
+
+    async def _run_ner(self, text: str) -> dict:
         doc = Doc(text)
+        # Разметка блокирующая, поэтому выполняется в отдельном пуле потоков
+        await asyncio.get_running_loop().run_in_executor(self._ner_executor, self._tag_doc, doc)
+        
+        return {
+            'organisations': [span.normal or span.text for span in doc.spans if span.type == "ORG"],
+            'persons': [span.normal or span.text for span in doc.spans if span.type == "PER"]
+        }
+
+    def _tag_doc(self, doc: Doc):
+        """Сегментация и NER-разметка документа Natasha"""
+        if self.ner_tagger is None:
+            # NER вызван до initialize(): загружаем общие модели один раз
+            self.preload_models()
+            self.segmenter = self._shared_segmenter
+            self.emb = self._shared_emb
+            self.ner_tagger = self._shared_ner_tagger
         doc.segment(self.segmenter)
         doc.tag_ner(self.ner_tagger)
+
+    async def _identify_roles(self, document_text: str) -> dict:
+        response = await self.generate_gpt_response(
+            prompt_type="roles",
+            user_prompt=f"Документ:\n{document_text}",
+            chat_id=None,
+            max_tokens=1500
+        )
         
-        organisations = []
-        persons = []
-        
-        for span in doc.spans:
-            if span.type == "ORG":
-                org_name = span.normal if span.normal else span.text
-                organisations.append(org_name)
-            elif span.type == "PER":
-                person_name = span.normal if span.normal else span.text
-                persons.append(person_name)
-        
-        result = {
-            'organisations': organisations,
-            'persons': persons
-        }
+        json_span = _extract_json_span(response)
+        if not json_span:
+            raise ValueError("GPT не вернул JSON с ролями")
         
-        self.ner_cache[text] = result
+        result = orjson.loads(json_span)
+        # Добавляем стандартные переменные, если их нет (с сохранением порядка)
+        existing = result.get("variables", [])
+        result["variables"] = list(dict.fromkeys([*existing, *STANDARD_VARS]))
         return result
 
-    async def identify_roles(self, document_text: str) -> dict:
-        try:
-            response = await self.generate_gpt_response(
-                prompt_type="roles",
-                user_prompt=f"Документ:\n{document_text}",
-                chat_id=None
-            )
-            
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group(0))
-                # Добавляем стандартные переменные, если их нет
-                if "variables" not in result:
-                    result["variables"] = []
-                standard_vars = ["АДРЕС_ОБЪЕКТА", "ПЛОЩАДЬ", "КАДАСТРОВЫЙ_НОМЕР", "АРЕНДНАЯ_ПЛАТА", 
-                                 "СРОК_АРЕНДЫ", "ДАТА_НАЧАЛА", "ДАТА_ОКОНЧАНИЯ", "СТАВКА_НДС", 
-                                 "ДЕПОЗИТ", "КОММУНАЛЬНЫЕ_ПЛАТЕЖИ"]
-                for var in standard_vars:
-                    if var not in result["variables"]:
-                        result["variables"].append(var)
-                return result
-            return {"roles": {}, "field_descriptions": {}, "variables": []}
-        except Exception as e:
-            logger.error("Ошибка определения ролей: %s", e)
-            return {"roles": {}, "field_descriptions": {}, "variables": []}
-
-    def map_variable_to_question(self, var_name: str, role_info: dict) -> str:
-        role = None
-        for role_name, role_data in role_info.get("roles", {}).items():
-            if var_name in role_data.get("fields", []):
-                role = role_name
-                break
+    def map_variable_to_question(self, var_name: str, role_info: dict, role: str = None) -> str:
+        if role is None:
+            role = _field_roles(role_info).get(var_name)
         
         description = role_info.get("field_descriptions", {}).get(var_name, var_name.replace("_", " ").lower())
         
@@ -404,29 +828,6 @@ class BotApplication:
             if pattern in var_name:
                 return validator(value)
         return True
-    
-    def num2words(self, num: int) -> str:
-        """Конвертирует число в прописной формат (упрощенная версия)"""
-        units = ['', 'один', 'два', 'три', 'четыре', 'пять', 'шесть', 'семь', 'восемь', 'девять']
-        teens = ['десять', 'одиннадцать', 'двенадцать', 'тринадцать', 'четырнадцать', 'пятнадцать', 
-                'шестнадцать', 'семнадцать', 'восемнадцать', 'девятнадцать']
-        tens = ['', '', 'двадцать', 'тридцать', 'сорок', 'пятьдесят', 
-               'шестьдесят', 'семьдесят', 'восемьдесят', 'девяносто']
-        hundreds = ['', 'сто', 'двести', 'триста', 'четыреста', 'пятьсот', 
-                   'шестьсот', 'семьсот', 'восемьсот', 'девятьсот']
-        
-        def _convert(n):
-            if n < 10:
-                return units[n]
-            elif 10 <= n < 20:
-                return teens[n-10]
-            elif 20 <= n < 100:
-                return tens[n//10] + (' ' + units[n%10] if n%10 !=0 else '')
-            elif 100 <= n < 1000:
-                return hundreds[n//100] + (' ' + _convert(n%100) if n%100 !=0 else '')
-            return ''
-        
-        return _convert(num).strip()
 
     @asynccontextmanager
     async def show_loading(self, chat_id: int, action: str = ChatAction.TYPING):
@@ -434,26 +835,49 @@ class BotApplication:
             yield
             return
             
-        stop_event = asyncio.Event()
-        
-        async def loading_animation():
-            while not stop_event.is_set():
-                try:
-                    await self.bot.send_chat_action(chat_id, action)
-                except Exception as e:
-                    logger.error("Ошибка отправки действия: %s", e)
-                await asyncio.sleep(4.9)
-        
-        loader_task = asyncio.create_task(loading_animation())
+        # Сами chat action отправляет _action_pump, здесь только регистрация чата
+        actions = self._active_actions.setdefault(chat_id, [])
+        actions.append(action)
+        if len(actions) == 1:
+            self._action_deadlines[chat_id] = asyncio.get_running_loop().time() + CHAT_ACTION_DELAY
+            self._action_wakeup.set()
         try:
             yield
         finally:
-            stop_event.set()
+            actions.remove(action)
+            if not actions:
+                del self._active_actions[chat_id]
+                del self._action_deadlines[chat_id]
+
+    async def _action_pump(self):
+        """Единый планировщик chat action для всех чатов с активной загрузкой"""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            due = [chat_id for chat_id, deadline in self._action_deadlines.items() if deadline <= now]
+            if due:
+                for chat_id in due:
+                    self._action_deadlines[chat_id] = now + CHAT_ACTION_INTERVAL
+                await asyncio.gather(*(
+                    self._send_chat_action(chat_id, self._active_actions[chat_id][-1])
+                    for chat_id in due
+                ))
+                continue
+            
+            # Спим до ближайшего дедлайна или до появления нового чата
+            timeout = min(self._action_deadlines.values()) - now if self._action_deadlines else None
+            self._action_wakeup.clear()
             try:
-                await loader_task
-            except:
+                await asyncio.wait_for(self._action_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
                 pass
 
+    async def _send_chat_action(self, chat_id: int, action: str):
+        try:
+            await self.bot.send_chat_action(chat_id, action)
+        except Exception as e:
+            logger.error("Ошибка отправки действия: %s", e)
+
     def register_handlers(self):
         self._register_start_handlers()
         self._register_rent_handlers()
@@ -477,7 +901,7 @@ class BotApplication:
                 )
                 await state.set_state(self.states.initial_input)
             except Exception as e:
-                logger.error("Ошибка в /start: %s\n%s", e, traceback.format_exc())
+                logger.exception("Ошибка в /start: %s", e)
                 await message.answer("⚠️ Произошла внутренняя ошибка. Попробуйте позже.")
 
         @self.dp.message(self.states.initial_input)
@@ -487,25 +911,14 @@ class BotApplication:
                     await message.answer("⚠️ Слишком длинный текст. Укороти, пожалуйста.")
                     return
 
-                await state.update_data(initial_text=message.text)
-                
-                # Проверяем, относится ли запрос к аренде
-                is_rental = any(keyword in message.text.lower() for keyword in 
-                               ["аренд", "съем", "помещен", "площад", "офис", "магазин", "кафе", "салон"])
-                
-                await state.update_data(is_rental=is_rental)
+                # Определяем тип бизнеса и признак аренды за один проход по тексту
+                found_types = set()
+                is_rental = False
+                for match in BUSINESS_RE.finditer(message.text):
+                    found_types.add(match.lastgroup)
+                    is_rental = is_rental or match.group().lower().startswith(RENTAL_PREFIXES)
                 
-                # Определяем тип бизнеса
-                business_type = "other"
-                text_lower = message.text.lower()
-                if any(kw in text_lower for kw in ["кафе", "кофейн", "ресторан", "столов", "бар"]):
-                    business_type = "cafe"
-                elif any(kw in text_lower for kw in ["магазин", "торгов", "рознич", "бутик"]):
-                    business_type = "shop"
-                elif any(kw in text_lower for kw in ["салон красот", "парикмахер", "ногтев", "косметолог"]):
-                    business_type = "beauty"
-                
-                await state.update_data(business_type=business_type)
+                business_type = next((t for t in BUSINESS_PRIORITY if t in found_types), "other")
                 
                 if is_rental:
                     await message.answer(
@@ -519,17 +932,24 @@ class BotApplication:
                         "<i>Пример: Офисное помещение 35 м², без мебели, арендодатель на УСН, "
                         "коммунальные платежи включены в аренду, депозит 2 месяца</i>"
                     )
-                    await state.set_state(self.states.rent_details)
+                    next_state = self.states.rent_details
                 else:
                     await message.answer(
                         "👥 <b>Укажите стороны договора:</b>\n\n"
                         "<i>Пример:\nАрендодатель: ООО 'Ромашка'\n"
                         "Арендатор: Иван Иванов (ИП)</i>"
                     )
-                    await state.set_state(self.states.parties_info)
+                    next_state = self.states.parties_info
+                
+                await self.set_state_with_data(
+                    state, next_state,
+                    initial_text=message.text,
+                    is_rental=is_rental,
+                    business_type=business_type
+                )
                 
             except Exception as e:
-                logger.error("Ошибка обработки: %s\n%s", e, traceback.format_exc())
+                logger.exception("Ошибка обработки: %s", e)
                 await message.answer("⚠️ Ошибка обработки. Попробуйте снова.")
                 await state.clear()
 
@@ -538,15 +958,14 @@ class BotApplication:
         async def handle_rent_details(message: Message, state: FSMContext):
             try:
                 rent_details = message.text
-                await state.update_data(rent_details=rent_details)
                 
                 async with self.show_progress_context(message.chat.id, 8, "Анализ деталей аренды"):
                     # Извлекаем структурированные параметры аренды
                     rental_params = await self.extract_rental_params(rent_details)
-                    await state.update_data(rental_params=rental_params)
                     
                     # Проверяем обязательные параметры
                     if not rental_params.get("property_type") or not rental_params.get("area"):
+                        await state.update_data(rent_details=rent_details, rental_params=rental_params)
                         await message.answer(
                             "⚠️ <b>Не указаны ключевые параметры:</b>\n"
                             "Пожалуйста, укажите как минимум:\n"
@@ -587,10 +1006,14 @@ class BotApplication:
                         "<i>Пример:\nАрендодатель: ИП Сидоров А.В.\n"
                         "Арендатор: ООО 'Вектор'</i>"
                     )
-                    await state.set_state(self.states.parties_info)
+                    await self.set_state_with_data(
+                        state, self.states.parties_info,
+                        rent_details=rent_details,
+                        rental_params=rental_params
+                    )
                 
             except Exception as e:
-                logger.error("Ошибка обработки деталей аренды: %s\n%s", e, traceback.format_exc())
+                logger.exception("Ошибка обработки деталей аренды: %s", e)
                 await message.answer("⚠️ Ошибка обработки деталей аренды. Попробуйте снова.")
                 await state.clear()
 
@@ -599,7 +1022,6 @@ class BotApplication:
         async def handle_parties_info(message: Message, state: FSMContext):
             try:
                 parties_text = message.text
-                await state.update_data(parties_text=parties_text)
                 
                 async with self.show_progress_context(message.chat.id, 10, "Анализ сторон договора"):
                     # Извлекаем информацию о сторонах
@@ -623,9 +1045,12 @@ class BotApplication:
                         return
                         
                     # Показываем пользователю, как мы поняли стороны
-                    confirmation = "✅ Определены стороны договора:\n"
-                    for party in parties_info["parties"]:
-                        confirmation += f"<b>{party['role']}:</b> {party['name']} ({party['type']})\n"
+                    lines = ["✅ Определены стороны договора:\n"]
+                    lines.extend(
+                        f"<b>{party['role']}:</b> {party['name']} ({party['type']})\n"
+                        for party in parties_info["parties"]
+                    )
+                    confirmation = "".join(lines)
                     
                     await message.answer(confirmation)
                     
@@ -642,11 +1067,14 @@ class BotApplication:
                         reply_markup=keyboard
                     )
                     
-                    await state.update_data(parties_info=parties_info)
-                    await state.set_state(self.states.parties_confirmation)
+                    await self.set_state_with_data(
+                        state, self.states.parties_confirmation,
+                        parties_text=parties_text,
+                        parties_info=parties_info
+                    )
                 
             except Exception as e:
-                logger.error("Ошибка обработки информации о сторонах: %s\n%s", e, traceback.format_exc())
+                logger.exception("Ошибка обработки информации о сторонах: %s", e)
                 await message.answer("⚠️ Ошибка обработки информации о сторонах. Попробуйте снова.")
                 await state.clear()
 
@@ -738,10 +1166,10 @@ class BotApplication:
                 )
 
                 filename = f"draft_{callback.message.from_user.id}.docx"
-                path = self.save_docx(document, filename)
+                docx_data = await self.render_docx(document)
                 
                 await state.update_data(document_text=document)
-                await callback.message.answer_document(FSInputFile(path))
+                await callback.message.answer_document(BufferedInputFile(docx_data, filename=filename))
                 await callback.message.answer(
                     "📄 Черновик договора готов! Теперь заполним обязательные реквизиты."
                 )
@@ -776,8 +1204,6 @@ class BotApplication:
         async def handle_additional_clauses(message: Message, state: FSMContext):
             try:
                 selected_clauses = message.text
-                await state.update_data(additional_clauses=selected_clauses)
-                
                 data = await state.get_data()
                 base_text = data.get("final_document", "")
                 
@@ -790,13 +1216,16 @@ class BotApplication:
                     )
 
                     filename = f"updated_{message.from_user.id}.docx"
-                    path = self.save_docx(updated_doc, filename)
+                    docx_data = await self.render_docx(updated_doc)
                     
-                    await message.answer_document(FSInputFile(path))
+                    await message.answer_document(BufferedInputFile(docx_data, filename=filename))
                     await message.answer("✅ Договор обновлен с учетом выбранных условий!")
                     
                     # Обновляем финальный документ
-                    await state.update_data(final_document=updated_doc)
+                    await state.update_data(
+                        additional_clauses=selected_clauses,
+                        final_document=updated_doc
+                    )
                     
                     # Предлагаем финальные действия
                     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -814,7 +1243,7 @@ class BotApplication:
                     )
                     
             except Exception as e:
-                logger.error("Ошибка обработки: %s\n%s", e, traceback.format_exc())
+                logger.exception("Ошибка обработки: %s", e)
                 await message.answer("⚠️ Ошибка обработки. Попробуйте снова.")
                 await state.set_state(self.states.document_review)
 
@@ -849,9 +1278,9 @@ class BotApplication:
                     )
 
                     filename = f"custom_{message.from_user.id}.docx"
-                    path = self.save_docx(updated_doc, filename)
+                    docx_data = await self.render_docx(updated_doc)
                     
-                    await message.answer_document(FSInputFile(path))
+                    await message.answer_document(BufferedInputFile(docx_data, filename=filename))
                     await message.answer("✅ Особые условия добавлены в договор!")
                     
                     # Обновляем документ в состоянии
@@ -874,7 +1303,7 @@ class BotApplication:
             try:
                 data = await state.get_data()
                 current_var = data['current_variable']
-                user_input = message.text
+                user_input = (message.text or "").strip()
                 
                 # Валидация ввода
                 if not self.validate_input(current_var, user_input):
@@ -906,81 +1335,80 @@ class BotApplication:
                 await self.ask_next_variable(message, state)
                 
             except Exception as e:
-                logger.error("Ошибка обработки ввода переменной: %s\n%s", e, traceback.format_exc())
+                logger.exception("Ошибка обработки ввода переменной: %s", e)
                 await message.answer("⚠️ Ошибка обработки. Попробуйте снова.")
                 await state.clear()
 
     async def extract_rental_params(self, text: str) -> dict:
         """Извлекает структурированные параметры аренды из текста с резервной логикой"""
         try:
-            response = await self.generate_gpt_response(
-                prompt_type="rent_params",
-                user_prompt=text,
-                chat_id=None
-            )
-            
-            # Пытаемся распарсить JSON
-            try:
-                json_match = re.search(r'\{.*\}', response, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group(0))
-                    
-                    # Проверка и дополнение критических параметров
-                    if not result.get("property_type"):
-                        # Эвристика для определения типа помещения
-                        if any(kw in text.lower() for kw in ["офис", "офисное"]):
-                            result["property_type"] = "офисное"
-                        elif any(kw in text.lower() for kw in ["магазин", "торгов", "бутик"]):
-                            result["property_type"] = "торговое"
-                        elif any(kw in text.lower() for kw in ["производств", "цех"]):
-                            result["property_type"] = "производственное"
-                        elif any(kw in text.lower() for kw in ["склад"]):
-                            result["property_type"] = "складское"
-                        else:
-                            result["property_type"] = "не указано"
-                    
-                    if not result.get("area"):
-                        # Резервное извлечение площади через регулярные выражения
-                        area_match = re.search(r'(\d+)\s*(м²|м2|кв\.?м|кв|м\s*кв)', text)
-                        if area_match:
-                            result["area"] = area_match.group(1)
-                    
-                    return result
-            except json.JSONDecodeError:
-                logger.warning(f"Невалидный JSON: {response}")
-        
+            return await self._cached("rent_params", text, lambda: self._extract_rental_params(text))
         except Exception as e:
-            logger.error(f"Ошибка извлечения параметров: {e}")
+            logger.error("Ошибка извлечения параметров: %s", e)
+            # Fallback: возвращаем пустой словарь
+            return {}
+
+    async def _extract_rental_params(self, text: str) -> dict:
+        response = await self.generate_gpt_response(
+            prompt_type="rent_params",
+            user_prompt=text,
+            chat_id=None,
+            max_tokens=500
+        )
+        
+        json_span = _extract_json_span(response)
+        if not json_span:
+            raise ValueError("GPT не вернул JSON с параметрами аренды")
+        result = orjson.loads(json_span)
         
-        # Fallback: возвращаем пустой словарь
-        return {}
+        # Проверка и дополнение критических параметров
+        if not result.get("property_type"):
+            # Эвристика для определения типа помещения
+            text_lower = text.casefold()
+            if any(kw in text_lower for kw in ["офис", "офисное"]):
+                result["property_type"] = "офисное"
+            elif any(kw in text_lower for kw in ["магазин", "торгов", "бутик"]):
+                result["property_type"] = "торговое"
+            elif any(kw in text_lower for kw in ["производств", "цех"]):
+                result["property_type"] = "производственное"
+            elif any(kw in text_lower for kw in ["склад"]):
+                result["property_type"] = "складское"
+            else:
+                result["property_type"] = "не указано"
+        
+        if not result.get("area"):
+            # Резервное извлечение площади через регулярные выражения
+            area_match = AREA_RE.search(text)
+            if area_match:
+                result["area"] = area_match.group(1)
+        
+        return result
 
     async def extract_parties_info(self, text: str) -> dict:
         """Извлекает структурированную информацию о сторонах договора с улучшенным определением ролей"""
+        return await self._cached("parties", text, lambda: self._extract_parties_info(text))
+
+    async def _extract_parties_info(self, text: str) -> dict:
         # Нормализуем текст: приводим к нижнему регистру, убираем лишние пробелы
-        normalized_text = re.sub(r'\s+', ' ', text.lower()).strip()
-        
-        # Определяем роли по ключевым словам
-        landlord_keywords = ["арендодатель", "собственник", "лизингодатель", "арендодателя", "owner", "lessor"]
-        tenant_keywords = ["арендатор", "наниматель", "лизингополучатель", "арендатора", "tenant", "lessee"]
+        normalized_text = WHITESPACE_RE.sub(' ', text.lower()).strip()
         
         # Пытаемся найти роли в тексте
         landlord = None
         tenant = None
         
         # Ищем арендодателя
-        for keyword in landlord_keywords:
+        for keyword, pattern in LANDLORD_PATTERNS:
             if keyword in normalized_text:
                 # Извлекаем текст после ключевого слова
-                match = re.search(fr"{keyword}[:\-—\s]*(.+?)(?:{tenant_keywords[0]}|$)", normalized_text)
+                match = pattern.search(normalized_text)
                 if match:
                     landlord = match.group(1).strip()
                     break
         
         # Ищем арендатора
-        for keyword in tenant_keywords:
+        for keyword, pattern in TENANT_PATTERNS:
             if keyword in normalized_text:
-                match = re.search(fr"{keyword}[:\-—\s]*(.+)", normalized_text)
+                match = pattern.search(normalized_text)
                 if match:
                     tenant = match.group(1).strip()
                     break
@@ -988,7 +1416,7 @@ class BotApplication:
         # Если не нашли по ключевым словам, используем эвристику: первое упомянутое лицо - арендодатель
         if not landlord or not tenant:
             # Используем Natasha для извлечения сущностей
-            entities = self.extract_entities(text)
+            entities = await self.extract_entities(text)
             
             # Объединяем организации и персоны
             all_entities = entities['organisations'] + entities['persons']
@@ -1001,7 +1429,7 @@ class BotApplication:
                 tenant = "Не определено"
             else:
                 # Резервный метод: разделяем по запятым или союзам
-                parts = re.split(r'[,;и]| арендодатель | арендатор ', text, flags=re.IGNORECASE)
+                parts = PARTIES_SPLIT_RE.split(text)
                 parts = [p.strip() for p in parts if p.strip()]
                 
                 if len(parts) >= 2:
@@ -1042,48 +1470,18 @@ class BotApplication:
         
         text_lower = text.lower()
         
-        # Список юридических форм с приоритетом
-        legal_forms = {
-            "ип": "ИП",
-            "индивидуальный предприниматель": "ИП",
-            "ооо": "ООО",
-            "общество с ограниченной ответственностью": "ООО",
-            "ао": "АО",
-            "оао": "АО",
-            "зао": "АО",
-            "пао": "АО",
-            "акционерное общество": "АО",
-            "публичное акционерное общество": "АО",
-            "закрытое акционерное общество": "АО",
-            "нко": "НКО",
-            "некоммерческая организация": "НКО",
-            "пк": "ПК",
-            "производственный кооператив": "ПК",
-            "кфх": "КФХ",
-            "крестьянское фермерское хозяйство": "КФХ",
-            "тсн": "ТСН",
-            "товарищество собственников недвижимости": "ТСН",
-            "потребительский кооператив": "ПК",
-            "адвокатское образование": "АО",
-            "адвокатское бюро": "АО",
-            "коллегия адвокатов": "КА",
-            "юридическая компания": "ЮК",
-            "юридическое лицо": "ЮЛ",
-        }
-        
         # Проверка явных указаний юридической формы
-        for pattern, form in legal_forms.items():
-            if re.search(rf"\b{pattern}\b", text_lower):
-                return form
+        found = [m.group(1) for m in LEGAL_FORMS_RE.finditer(text_lower)]
+        if found:
+            return LEGAL_FORMS[min(found, key=LEGAL_FORM_PRIORITY.__getitem__)]
         
         # Физические лица - явные указания
-        if re.search(r"\bфл\b|\bфиз\b|\bгражданин\b|\bг-н\b|\bфизлицо\b", text_lower):
+        if PERSON_MARKERS_RE.search(text_lower):
             return "физическое лицо"
         
         # Физические лица - по формату ФИО
         # Формат: Фамилия Имя Отчество или Фамилия И.О.
-        if (re.search(r"\b[а-яё]+\s+[а-яё][.\s]*[а-яё]?[.\s]*[а-яё]?[.]?\b", text_lower) or
-            re.search(r"[А-ЯЁ]\.[\s]*[А-ЯЁ]\.[\s]*[А-ЯЁ][а-яё]+", text)):
+        if PERSON_NAME_RE.search(text_lower) or PERSON_INITIALS_RE.search(text):
             return "физическое лицо"
         
         # Физические лица - эвристика по структуре имени
@@ -1094,7 +1492,7 @@ class BotApplication:
                 return "физическое лицо"
         
         # Проверка по ИНН (10 или 12 цифр)
-        inn_match = re.search(r"\b\d{10,12}\b", text)
+        inn_match = INN_RE.search(text)
         if inn_match:
             inn = inn_match.group(0)
             if len(inn) == 10:
@@ -1108,63 +1506,75 @@ class BotApplication:
     async def start_variable_filling(self, message: Message, state: FSMContext):
         data = await state.get_data()
         document_text = data['document_text']
-        role_info = await self.identify_roles(document_text)
+        is_rental = bool(data.get('is_rental'))
+        
+        # План опроса зависит только от текста документа и типа договора, поэтому кэшируется
+        try:
+            plan = await self._cached(
+                "varplan", f"{int(is_rental)}:{document_text}",
+                lambda: self._variable_plan(document_text, is_rental),
+                ttl=VAR_PLAN_TTL
+            )
+        except Exception as e:
+            logger.error("Ошибка определения ролей: %s", e)
+            plan = self._build_variable_plan(
+                document_text, is_rental, {"roles": {}, "field_descriptions": {}, "variables": []}
+            )
         
-        # Извлекаем переменные из документа
-        raw_vars = list(set(re.findall(r'\[(.*?)\]', document_text)))
+        filled = data.get('filled_variables', {})
+        if is_rental:
+            # Автоподстановка данных из rental_params
+            rental_params = data.get('rental_params', {})
+            for param, var in RENTAL_PARAM_VARS:
+                value = rental_params.get(param)
+                if value is None:
+                    continue
+                value = str(value).strip()
+                # Невалидное значение не подставляем: переменную спросим у пользователя
+                if value and self.validate_input(var, value):
+                    filled[var] = value
         
-        # Фильтруем переменные: оставляем только те, которые есть в role_info
-        all_vars = []
-        for var in raw_vars:
-            # Если переменная есть в описаниях или в списке переменных
-            if var in role_info.get("field_descriptions", {}) or var in role_info.get("variables", []):
-                all_vars.append(var)
+        # Логирование всех переменных
+        logger.info("Упорядоченные переменные: %s", plan["variables"])
         
-        # Добавляем обязательные переменные
+        await state.update_data(
+            variables=plan["variables"],
+            var_descriptions=plan["var_descriptions"],
+            filled_variables=filled,
+            current_variable_index=0,
+            real_indices=plan["real_indices"],
+            role_info=plan["role_info"]  # Сохраняем информацию о ролях
+        )
+        await self.ask_next_variable(message, state)
+
+    async def _variable_plan(self, document_text: str, is_rental: bool) -> dict:
+        # Ошибка определения ролей пробрасывается, чтобы неполный план не попал в кэш
+        role_info = await self._cached("roles", document_text, lambda: self._identify_roles(document_text))
+        return self._build_variable_plan(document_text, is_rental, role_info)
+
+    def _build_variable_plan(self, document_text: str, is_rental: bool, role_info: dict) -> dict:
+        """Строит упорядоченный по ролям список переменных и вопросы к ним"""
+        descriptions = role_info.setdefault("field_descriptions", {})
         required_vars = role_info.get("variables", [])
-        for var in required_vars:
-            if var not in all_vars:
-                all_vars.append(var)
+        known_vars = set(descriptions).union(required_vars)
+        
+        # Переменные документа, известные role_info, в порядке появления и без повторов,
+        # затем обязательные переменные (dict сохраняет порядок вставки)
+        all_vars = dict.fromkeys(var for var in PLACEHOLDER_RE.findall(document_text) if var in known_vars)
+        all_vars.update(dict.fromkeys(required_vars))
         
         # Для аренды добавляем специфичные поля
-        if data.get('is_rental'):
-            rent_specific_vars = [
-                "АДРЕС_ОБЪЕКТА", "ПЛОЩАДЬ", "КАДАСТРОВЫЙ_НОМЕР",
-                "АРЕНДНАЯ_ПЛАТА", "СРОК_АРЕНДЫ", "ДАТА_НАЧАЛА",
-                "ДАТА_ОКОНЧАНИЯ", "СТАвКА_НДС", "ДЕПОЗИТ",
-                "КОММУНАЛЬНЫЕ_ПЛАТЕЖИ", "ПОРЯДОК_ОПЛАТЫ"
-            ]
-            for var in rent_specific_vars:
+        if is_rental:
+            for var in RENT_SPECIFIC_VARS:
                 if var not in all_vars:
-                    all_vars.append(var)
-                    if var not in role_info["field_descriptions"]:
-                        role_info["field_descriptions"][var] = var.replace("_", " ").lower()
-                
-            # Автоподстановка данных из rental_params
-            rental_params = data.get('rental_params', {})
-            filled = data.get('filled_variables', {})
-            if 'area' in rental_params:
-                filled['ПЛОЩАДЬ'] = rental_params['area']
-            if 'address' in rental_params:
-                filled['АДРЕС_ОБЪЕКТА'] = rental_params['address']
-            if 'deposit' in rental_params:
-                filled['ДЕПОЗИТ'] = rental_params['deposit']
-            if 'utilities' in rental_params:
-                filled['КОММУНАЛЬНЫЕ_ПЛАТЕЖИ'] = rental_params['utilities']
-            await state.update_data(filled_variables=filled)
+                    all_vars[var] = None
+                    descriptions.setdefault(var, var.replace("_", " ").lower())
         
         # Группируем переменные по ролям
+        field_roles = _field_roles(role_info)
         grouped_vars = {}
         for var in all_vars:
-            role = "Общие"
-            for role_name, role_data in role_info.get("roles", {}).items():
-                if var in role_data.get("fields", []):
-                    role = role_name
-                    break
-                    
-            if role not in grouped_vars:
-                grouped_vars[role] = []
-            grouped_vars[role].append(var)
+            grouped_vars.setdefault(field_roles.get(var, "Общие"), []).append(var)
         
         # Создаем плоский список с сохранением порядка групп
         ordered_vars = []
@@ -1174,7 +1584,7 @@ class BotApplication:
         if "Общие" in grouped_vars:
             for var in grouped_vars["Общие"]:
                 ordered_vars.append(var)
-                var_descriptions[var] = self.map_variable_to_question(var, role_info)
+                var_descriptions[var] = self.map_variable_to_question(var, role_info, field_roles.get(var, ""))
         
         # Затем специфичные для ролей
         for role, vars_list in grouped_vars.items():
@@ -1187,32 +1597,30 @@ class BotApplication:
             
             for var in vars_list:
                 ordered_vars.append(var)
-                var_descriptions[var] = self.map_variable_to_question(var, role_info)
+                var_descriptions[var] = self.map_variable_to_question(var, role_info, role)
         
-        # Логирование всех переменных
-        logger.info("Упорядоченные переменные: %s", ordered_vars)
-        
-        await state.update_data(
-            variables=ordered_vars,
-            var_descriptions=var_descriptions,
-            filled_variables=data.get('filled_variables', {}),
-            current_variable_index=0,
-            role_info=role_info  # Сохраняем информацию о ролях
-        )
-        await self.ask_next_variable(message, state)
+        return {
+            "variables": ordered_vars,
+            "var_descriptions": var_descriptions,
+            # Позиции настоящих переменных (без разделителей ролей) для быстрого перехода
+            "real_indices": [i for i, var in enumerate(ordered_vars) if not var.startswith("---")],
+            "role_info": role_info
+        }
 
     async def ask_next_variable(self, message: Message, state: FSMContext):
         data = await state.get_data()
         variables = data['variables']
-        index = data['current_variable_index']
         filled = data['filled_variables']
         var_descriptions = data['var_descriptions']
+        real_indices = data.get('real_indices')
+        if real_indices is None:
+            real_indices = [i for i, var in enumerate(variables) if not var.startswith("---")]
         
-        # Пропускаем разделители
-        while index < len(variables) and variables[index].startswith("---"):
-            index += 1
+        # Переходим сразу к первой незаполненной переменной, минуя разделители и предзаполненные
+        start = bisect.bisect_left(real_indices, data['current_variable_index'])
+        index = next((i for i in real_indices[start:] if variables[i] not in filled), None)
             
-        if index >= len(variables):
+        if index is None:
             async with self.show_progress_context(message.chat.id, 5, "Подготовка документа"):
                 await self.prepare_final_document(message, state)
             return
@@ -1220,17 +1628,6 @@ class BotApplication:
         current_var = variables[index]
         question = var_descriptions.get(current_var, f"✍️ Введите значение для {current_var}:")
         
-        # Проверяем, есть ли предзаполненное значение
-        if current_var in filled:
-            await state.update_data(current_variable_index=index+1)
-            await self.ask_next_variable(message, state)
-            return
-        
-        await state.update_data(
-            current_variable=current_var,
-            current_variable_index=index
-        )
-        
         # Добавляем валидацию для специфичных полей
         validation_hint = ""
         if "ИНН" in current_var:
@@ -1243,7 +1640,12 @@ class BotApplication:
             validation_hint = "\n\n⚠️ Укажите сумму в рублях (например: 50000)"
         
         await message.answer(f"{question}{validation_hint}")
-        await state.set_state(self.states.variable_input)  # Устанавливаем состояние для ввода
+        # Устанавливаем состояние для ввода вместе с текущей переменной
+        await self.set_state_with_data(
+            state, self.states.variable_input,
+            current_variable=current_var,
+            current_variable_index=index
+        )
 
     async def prepare_final_document(self, message: Message, state: FSMContext):
         try:
@@ -1251,17 +1653,14 @@ class BotApplication:
             document_text = data['document_text']
             filled = data['filled_variables']
             
-            # Заменяем плейсхолдеры значениями
-            for var, value in filled.items():
-                document_text = document_text.replace(f"[{var}]", value)
-            
+            values = dict(filled)
             # Особые преобразования
-            if 'АРЕНДНАЯ_ПЛАТА' in filled:
+            if _is_ascii_digits(filled.get('АРЕНДНАЯ_ПЛАТА')):
                 amount = int(filled['АРЕНДНАЯ_ПЛАТА'])
-                document_text = document_text.replace(
-                    "[АРЕНДНАЯ_ПЛАТА_ПРОПИСЬЮ]", 
-                    f"{amount} ({self.num2words(amount)}) рублей"
-                )
+                values.setdefault('АРЕНДНАЯ_ПЛАТА_ПРОПИСЬЮ', _amount_words(amount))
+            
+            # Заменяем плейсхолдеры значениями за один проход; незаполненные остаются как есть
+            document_text = PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), m.group(0)), document_text)
             
             # Проверка документа
             async with self.show_loading(message.chat.id, ChatAction.TYPING):
@@ -1273,14 +1672,13 @@ class BotApplication:
                     logger.warning("GPT вернул не документ: %s", reviewed_doc[:100])
                     reviewed_doc = document_text  # Используем исходную версию
             
-            # Сохраняем финальную версию
-            await state.update_data(final_document=reviewed_doc)
-            
             # Отправляем пользователю
             filename = f"final_{message.from_user.id}.docx"
-            path = self.save_docx(reviewed_doc, filename)
-            await message.answer_document(FSInputFile(path))
-            await state.set_state(self.states.document_review)
+            docx_data = await self.render_docx(reviewed_doc)
+            await message.answer_document(BufferedInputFile(docx_data, filename=filename))
+            
+            # Сохраняем финальную версию
+            await self.set_state_with_data(state, self.states.document_review, final_document=reviewed_doc)
             
             # Предлагаем дополнительные опции
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1316,23 +1714,27 @@ class BotApplication:
             
             # Генерируем финальный DOCX
             filename = f"Договор_аренды_{datetime.datetime.now().strftime('%d%m%Y')}.docx"
-            final_path = self.save_docx(document_text, filename)
-            await message.answer_document(FSInputFile(final_path))
+            docx_data = await self.render_docx(document_text)
+            await message.answer_document(BufferedInputFile(docx_data, filename=filename))
             
             # Для аренды генерируем дополнительные документы
             if data.get('is_rental', False):
                 async with self.show_progress_context(message.chat.id, 3, "Генерация документов"):
                     await message.answer("📝 <b>Генерирую дополнительные документы...</b>")
                     
-                    # Акт приема-передачи
-                    act_text = await self.generate_acceptance_act(data)
-                    act_path = self.save_docx(act_text, "Акт_приема-передачи.docx")
-                    await message.answer_document(FSInputFile(act_path))
-                    
-                    # Уведомление о расторжении
-                    termination_text = await self.generate_termination_notice(data)
-                    term_path = self.save_docx(termination_text, "Уведомление_о_расторжении.docx")
-                    await message.answer_document(FSInputFile(term_path))
+                    # Акт приема-передачи и уведомление о расторжении независимы — готовим параллельно
+                    act_text, termination_text = await asyncio.gather(
+                        self.generate_acceptance_act(data),
+                        self.generate_termination_notice(data)
+                    )
+                    act_data, term_data = await asyncio.gather(
+                        self.render_docx(act_text),
+                        self.render_docx(termination_text)
+                    )
+                    await message.answer_document(BufferedInputFile(act_data, filename="Акт_приема-передачи.docx"))
+                    await message.answer_document(
+                        BufferedInputFile(term_data, filename="Уведомление_о_расторжении.docx")
+                    )
                     
                     # Дополнительные рекомендации
                     await message.answer(
@@ -1352,14 +1754,6 @@ class BotApplication:
             )
             await state.clear()
 
-            # Удаляем временные файлы
-            if os.path.exists(final_path):
-                os.unlink(final_path)
-            
-            temp_path = data.get('document_path', '')
-            if temp_path and os.path.exists(temp_path):
-                os.unlink(temp_path)
-
         except Exception as e:
             logger.error("Ошибка отправки документа: %s", e)
             await message.answer("⚠️ Ошибка завершения. Попробуйте начать заново /start")
@@ -1372,7 +1766,8 @@ class BotApplication:
                 reviewed = await self.generate_gpt_response(
                     system_prompt=PROMPT_DOCUMENT_REVIEW,
                     user_prompt=f"Вот договор для исправления:\n\n{document}",
-                    chat_id=chat_id
+                    chat_id=chat_id,
+                    use_cache=True
                 )
             
             # Извлекаем текст договора из возможного форматированного ответа
@@ -1396,7 +1791,8 @@ class BotApplication:
             return await self.generate_gpt_response(
                 system_prompt="Ты юрист. Сгенерируй акт приема-передачи помещения к договору аренды.",
                 user_prompt=f"Данные договора:\n{data.get('final_document', '')}",
-                chat_id=None
+                chat_id=None,
+                use_cache=True
             )
         
         # Формируем контекст для шаблона
@@ -1433,7 +1829,8 @@ class BotApplication:
             return await self.generate_gpt_response(
                 system_prompt="Ты юрист. Сгенерируй уведомление о расторжении договора аренды.",
                 user_prompt=f"Данные договора:\n{data.get('final_document', '')}",
-                chat_id=None
+                chat_id=None,
+                use_cache=True
             )
         
         # Формируем контекст для шаблона
@@ -1457,7 +1854,9 @@ class BotApplication:
         return template.render(context)
 
     async def generate_gpt_response(self, system_prompt: str = None, user_prompt: str = None, 
-                                  prompt_type: str = None, chat_id: int = None) -> str:
+                                  prompt_type: str = None, chat_id: int = None,
+                                  model: str = GPT_MODEL, temperature: float = GPT_TEMPERATURE,
+                                  max_tokens: int = GPT_MAX_TOKENS, use_cache: bool = False) -> str:
         """Унифицированный метод для работы с OpenAI"""
         try:
             # Если указан тип промпта, используем предопределенный
@@ -1466,29 +1865,28 @@ class BotApplication:
             elif prompt_type == "rent_params":
                 system_prompt = PROMPT_RENT_PARAMS
             
-            if chat_id:
-                async with self.show_loading(chat_id, ChatAction.TYPING):
-                    response = await self.openai_client.chat.completions.create(
-                        model="gpt-3.5-turbo-0125",
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        temperature=0.2,
-                        max_tokens=3000
-                    )
-            else:
-                response = await self.openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo-0125",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=3000
-                )
+            loading = self.show_loading(chat_id, ChatAction.TYPING) if chat_id else nullcontext()
+            params = dict(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            async with loading:
+                if not use_cache:
+                    return await self._create_completion(**params)
                 
-            return response.choices[0].message.content.strip()
+                # Ключ не зависит от различий в пробелах пользовательского текста
+                cache_key = "\n".join((
+                    model, str(temperature), str(max_tokens),
+                    system_prompt, " ".join(user_prompt.split())
+                ))
+                return await self._cached(
+                    "gpt", cache_key, lambda: self._create_completion(**params), ttl=GPT_CACHE_TTL
+                )
         
         except httpx.ReadTimeout:
             logger.error("Timeout при запросе к OpenAI")
@@ -1497,21 +1895,59 @@ class BotApplication:
             logger.error("Ошибка OpenAI: %s", e)
             return "❌ Ошибка генерации. Попробуйте позже."
 
-    def save_docx(self, text: str, filename: str) -> str:
-        """Сохраняет текст в DOCX с использованием временных файлов"""
+    async def _create_completion(self, **params) -> str:
+        """Выполняет запрос к OpenAI, объединяя одинаковые параллельные запросы"""
+        key = hashlib.blake2b(orjson.dumps(params), digest_size=16).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._request_completion(**params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish_inflight(key, t))
+        # shield: отмена одного из ожидающих не прерывает общий запрос
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, key: str, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        # Если все ожидающие отменены, ошибку запроса никто не прочитает:
+        # забираем ее здесь, чтобы asyncio не писал "Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def _request_completion(self, **params) -> str:
+        """Запрос к OpenAI с повторами при перегрузке и сетевых сбоях"""
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(4),
+            wait=wait_exponential_jitter(initial=1, max=8),
+            retry=retry_if_exception_type((RateLimitError, InternalServerError, APIConnectionError)),
+            reraise=True
+        ):
+            with attempt:
+                parts = [part async for part in self._stream_completion(**params)]
+        return "".join(parts).strip()
+
+    async def _stream_completion(self, **params):
+        """Потоковый запрос к OpenAI: отдает фрагменты текста по мере генерации"""
+        stream = await self.openai_client.chat.completions.create(stream=True, **params)
+        async for chunk in stream:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+    async def render_docx(self, text: str) -> bytes:
+        """Формирует DOCX в отдельном потоке, не блокируя event loop"""
         try:
-            doc = Document()
-            for para in text.split("\n"):
-                if para.strip():
-                    doc.add_paragraph(para)
-            
-            with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp:
-                doc.save(tmp.name)
-                return tmp.name
+            return await asyncio.get_running_loop().run_in_executor(self._docx_executor, generate_doc_from_text, text)
         except Exception as e:
             logger.error("Ошибка создания DOCX: %s", e)
             raise
 
+    async def set_state_with_data(self, state: FSMContext, new_state: State, **kwargs):
+        """Обновляет данные и переключает состояние FSM одним пакетом команд Redis"""
+        data = await state.get_data()
+        data.update(kwargs)
+        await state.set_state_and_data(new_state, data)
+
     async def update_state(self, state: FSMContext, **kwargs):
         """Селективное обновление состояния"""
         data = await state.get_data()
@@ -1523,7 +1959,16 @@ class BotApplication:
             # Отменяем все активные задачи прогресса
             for task in self.progress_tasks.values():
                 task.cancel()
+            if self._action_pump_task:
+                self._action_pump_task.cancel()
                 
+            if self._ner_executor:
+                self._ner_executor.shutdown(wait=False)
+            if self._docx_executor:
+                self._docx_executor.shutdown(wait=False)
+            if self._http:
+                await self._http.aclose()
+            await close_gpt_client()
             if self.redis:
                 await self.redis.close()
             if self.bot:
@@ -1535,7 +1980,14 @@ class BotApplication:
     async def run(self):
         await self.initialize()
         try:
-            await self.dp.start_polling(self.bot)
+            # getUpdates и так отдает до 100 апдейтов за запрос; длинный таймаут сокращает
+            # число пустых запросов, а handle_as_tasks обрабатывает пачку параллельно
+            await self.dp.start_polling(
+                self.bot,
+                polling_timeout=30,
+                handle_as_tasks=True,
+                allowed_updates=self.dp.resolve_used_update_types()
+            )
         except Exception as e:
             logger.critical("Критическая ошибка: %s", e)
         finally:
@@ -1543,8 +1995,10 @@ class BotApplication:
 
 if __name__ == "__main__":
     app = BotApplication()
+    # Цикл uvloop передается при запуске: uvloop.install() устарел с uvloop 0.18
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        asyncio.run(app.run())
+        run(app.run())
     except KeyboardInterrupt:
         logger.info("Бот остановлен")
     except Exception as e:
@@ -1,18 +1,24 @@
+from cachetools import TTLCache
+
+
 class SessionData:
+    __slots__ = ("document_type", "answers", "is_complete")
+
     def __init__(self):
         self.document_type = None
         self.answers = {}
         self.is_complete = False
 
 class SessionManager:
-    def __init__(self):
-        self.sessions = {}
+    def __init__(self, maxsize=10_000, ttl=3600):
+        self.sessions = TTLCache(maxsize=maxsize, ttl=ttl)
 
     def get_session(self, user_id):
-        if user_id not in self.sessions:
-            self.sessions[user_id] = SessionData()
-        return self.sessions[user_id]
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = SessionData()
+            self.sessions[user_id] = session
+        return session
 
     def clear_session(self, user_id):
-        if user_id in self.sessions:
-            del self.sessions[user_id]
+        self.sessions.pop(user_id, None)
@@ -1,25 +1,72 @@
 
-import json
+import re
+import orjson
+import sqlite3
 import hashlib
+import threading
+import unicodedata
 from pathlib import Path
 
+import cachetools
+
 CACHE_DIR = Path("cache")
+# Все записи кэша в одной таблице SQLite вместо отдельного JSON-файла на каждый запрос
+CACHE_DB = CACHE_DIR / "cache.sqlite3"
+
+# Недавно прочитанные и записанные значения (в сериализованном виде, чтобы каждый
+# вызов получал новый объект): повторное чтение не обращается к диску
+_memory_cache = cachetools.LRUCache(maxsize=1024)
+
+_connection = None
+# Соединение и LRU общие для потоков (асинхронные вызовы gpt_cached обращаются
+# к кэшу через asyncio.to_thread), поэтому все обращения к ним идут под блокировкой
+_db_lock = threading.Lock()
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(CACHE_DB, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v BLOB) WITHOUT ROWID")
+        _connection = connection
+    return _connection
+
+# Приведение введенного пользователем запроса к канонической форме: запросы,
+# отличающиеся только регистром, пробелами или составной записью букв (й, ё),
+# дают один ключ. Применяется только к тексту запроса (см. gpt_cached), а не ко
+# всему ключу: документы и другие аргументы должны совпадать буквально
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_query(text):
+    text = unicodedata.normalize("NFC", text)
+    return _WHITESPACE_RE.sub(' ', text.casefold()).strip()
 
-def get_cache_path(key):
-    h = hashlib.sha256(key.encode()).hexdigest()
-    return CACHE_DIR / f"{h}.json"
+def get_cache_key(key):
+    # Хэш нужен только как короткий ключ: BLAKE2b-128 быстрее SHA-256
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
 
 def cache_exists(key):
-    return get_cache_path(key).exists()
+    k = get_cache_key(key)
+    with _db_lock:
+        if k in _memory_cache:
+            return True
+        return _get_connection().execute("SELECT 1 FROM kv WHERE k = ?", (k,)).fetchone() is not None
 
 def save_to_cache(key, value):
-    path = get_cache_path(key)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump({"data": value}, f)
+    k = get_cache_key(key)
+    data = orjson.dumps(value)
+    with _db_lock:
+        _get_connection().execute("INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)", (k, data))
+        _memory_cache[k] = data
 
 def load_from_cache(key):
-    path = get_cache_path(key)
-    if not path.exists():
-        return None
-    with open(path, 'r', encoding='utf-8') as f:
-        return json.load(f).get("data")
+    k = get_cache_key(key)
+    with _db_lock:
+        data = _memory_cache.get(k)
+        if data is None:
+            row = _get_connection().execute("SELECT v FROM kv WHERE k = ?", (k,)).fetchone()
+            if row is None:
+                return None
+            data = _memory_cache[k] = bytes(row[0])
+    return orjson.loads(data)
@@ -1,13 +1,65 @@
+import io
+import asyncio
+import tempfile
+
 from docx import Document
+from docx.oxml import OxmlElement
 
-# Функция для генерации .docx документа
-async def generate_docx(document_text: str):
-    doc = Document()
+# Пустой документ сериализуется один раз: Document() без аргументов
+# каждый раз заново ищет и читает default.docx из пакета python-docx
+def _blank_docx_bytes():
+    buffer = io.BytesIO()
+    Document().save(buffer)
+    return buffer.getvalue()
+
+_BLANK_DOCX = _blank_docx_bytes()
+
+def new_document():
+    return Document(io.BytesIO(_BLANK_DOCX))
+
+# Добавление абзацев одним блоком XML: add_paragraph на каждую строку
+# каждый раз ищет позицию вставки в теле документа
+def append_paragraphs(doc, lines):
+    paragraphs = []
+    for line in lines:
+        p = OxmlElement("w:p")
+        if line:
+            r = OxmlElement("w:r")
+            # Сеттер text элемента w:r, как и add_paragraph, превращает \t в w:tab,
+            # \r и \n в w:br и расставляет xml:space="preserve"
+            r.text = line
+            p.append(r)
+        paragraphs.append(p)
+
+    body = doc.element.body
+    # Абзацы должны идти перед параметрами раздела (w:sectPr) в конце тела
+    sect_pr = body.sectPr
+    position = body.index(sect_pr) if sect_pr is not None else len(body)
+    body[position:position] = paragraphs
+
+# DOCX в памяти из обычного текста: по абзацу на каждую непустую строку
+def generate_doc_from_text(text: str) -> bytes:
+    doc = new_document()
+    append_paragraphs(doc, [line for line in text.split("\n") if line.strip()])
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def _generate_docx_sync(document_text: str):
+    doc = new_document()
     doc.add_heading('Юридический документ', 0)
-    doc.add_paragraph(document_text)
+    append_paragraphs(doc, document_text.split("\n"))
 
-    # Сохранение документа во временный файл
-    temp_file_path = "/tmp/document.docx"
-    doc.save(temp_file_path)
-    
-    return temp_file_path
+    # Архив собирается в памяти, а на диск попадает одной записью
+    buffer = io.BytesIO()
+    doc.save(buffer)
+
+    # Сохранение документа в уникальный временный файл (параллельные запросы не перезаписывают друг друга)
+    with tempfile.NamedTemporaryFile(suffix=".docx", delete=False, buffering=0) as tmp:
+        tmp.write(buffer.getbuffer())
+        return tmp.name
+
+# Функция для генерации .docx документа: python-docx синхронный, поэтому работает в отдельном потоке
+async def generate_docx(document_text: str):
+    return await asyncio.to_thread(_generate_docx_sync, document_text)
@@ -1,40 +1,128 @@
 
-import openai
-import json
 import os
+import orjson
+import asyncio
+import functools
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+import httpx
+from openai import AsyncOpenAI
 
-def extract_doc_data(prompt_text):
-    system_prompt = (
-        "Ты юридический ассистент. Преобразуй описание в JSON с ключами: "
-        "тип_документа (services, act, nda), название_стороны, дата, номер_договора, сумма. "
-        "Без комментариев и лишнего текста. Только JSON."
-    )
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt_text}
-        ],
-        temperature=0,
-        max_tokens=500
+from utils.cache_manager import load_from_cache, save_to_cache, normalize_query
+
+MODEL = "gpt-3.5-turbo-0125"
+
+# Асинхронный клиент: запросы не блокируют event loop и могут выполняться параллельно.
+# Клиент и пул соединений создаются при первом запросе (уже внутри event loop):
+# без OPENAI_API_KEY модуль по-прежнему импортируется
+_http_client = None
+_client = None
+
+def get_client():
+    global _client, _http_client
+    if _client is None:
+        # Один пул соединений на модуль: keep-alive избавляет от TLS-рукопожатия на каждый запрос
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=3, http_client=http_client)
+        _http_client = http_client
+    return _client
+
+# Закрытие пула соединений при завершении бота
+async def close_client():
+    global _client, _http_client
+    http_client, _client, _http_client = _http_client, None, None
+    if http_client is not None:
+        await http_client.aclose()
+
+# Кэширование ответов OpenAI на диске: одинаковый запрос не уходит в API повторно.
+# Ключ — пространство имен, модель, температура и аргументы функции.
+# Пустые ответы (None) не кэшируются; bypass_cache=True принудительно обращается к API.
+# normalize_prompt=True: первый аргумент — введенный пользователем запрос, в ключе он
+# приводится к канонической форме (в API уходит исходный текст)
+def gpt_cached(namespace, model=MODEL, temperature=0, normalize_prompt=False):
+    def decorator(func):
+        def make_key(args, kwargs):
+            if normalize_prompt and args and isinstance(args[0], str):
+                args = (normalize_query(args[0]), *args[1:])
+            prompt = orjson.dumps([args, kwargs], option=orjson.OPT_SORT_KEYS, default=str).decode()
+            return "|".join((namespace, model, str(temperature), prompt))
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, bypass_cache=False, **kwargs):
+            key = make_key(args, kwargs)
+            # Кэш на SQLite блокирующий, поэтому обращения к нему идут в отдельном потоке
+            if not bypass_cache:
+                cached = await asyncio.to_thread(load_from_cache, key)
+                if cached is not None:
+                    return cached
+            result = await func(*args, **kwargs)
+            if result is not None:
+                await asyncio.to_thread(save_to_cache, key, result)
+            return result
+        return async_wrapper
+    return decorator
+
+# Системные промпты и готовые начала списков сообщений (собираются один раз)
+# Формат ответа задает response_format, поэтому промпт только перечисляет ключи
+# (слово JSON в сообщениях обязательно для режима json_object)
+EXTRACT_SYSTEM_PROMPT = (
+    "Ты юридический ассистент. Преобразуй описание в JSON с ключами: "
+    "тип_документа (services, act, nda), название_стороны, дата, номер_договора, сумма."
+)
+SECTION_SYSTEM_PROMPT = "Ты юрист. Пиши только текст для вставки в договор."
+EXTRACT_MESSAGES_PREFIX = ({"role": "system", "content": EXTRACT_SYSTEM_PROMPT},)
+SECTION_MESSAGES_PREFIX = ({"role": "system", "content": SECTION_SYSTEM_PROMPT},)
+# Температуры запросов: одно значение и для API, и для ключа кэша
+EXTRACT_TEMPERATURE = 0
+SECTION_TEMPERATURE = 0.3
+# Сколько символов конца договора отправлять как контекст стиля и нумерации пунктов
+SECTION_CONTEXT_CHARS = 2000
+
+@gpt_cached("extract_doc_data", temperature=EXTRACT_TEMPERATURE, normalize_prompt=True)
+async def extract_doc_data(prompt_text):
+    completion = await get_client().chat.completions.create(
+        model=MODEL,
+        messages=[*EXTRACT_MESSAGES_PREFIX, {"role": "user", "content": prompt_text}],
+        response_format={"type": "json_object"},
+        temperature=EXTRACT_TEMPERATURE,
+        max_tokens=200
     )
-    reply = completion.choices[0].message["content"]
+    reply = completion.choices[0].message.content
+    try:
+        return orjson.loads(reply)
+    except orjson.JSONDecodeError:
+        pass
+    # Ответ с текстом вокруг JSON: разбираем фрагмент от первой { до последней },
+    # не делая повторного запроса к API
+    start, end = reply.find("{"), reply.rfind("}")
+    if start == -1 or end < start:
+        return None
     try:
-        return json.loads(reply)
-    except json.JSONDecodeError:
+        return orjson.loads(reply[start:end + 1])
+    except orjson.JSONDecodeError:
         return None
 
-def gpt_add_section(original_text, section_topic):
-    prompt = f"Добавь в конец этого договора пункт о {section_topic} в официальном юридическом стиле. Документ:\n\n{original_text}"
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Ты юрист. Пиши только текст для вставки в договор."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.3,
+# Кэшируется только сгенерированный пункт (ключ — окончание договора и тема),
+# сам договор в кэш не попадает
+@gpt_cached("gpt_add_section", temperature=SECTION_TEMPERATURE)
+async def _write_section(tail, section_topic):
+    prompt = (
+        f"Напиши пункт о {section_topic} в официальном юридическом стиле для добавления в конец договора. "
+        f"Верни только текст нового пункта. Окончание договора:\n\n{tail}"
+    )
+    completion = await get_client().chat.completions.create(
+        model=MODEL,
+        messages=[*SECTION_MESSAGES_PREFIX, {"role": "user", "content": prompt}],
+        temperature=SECTION_TEMPERATURE,
         max_tokens=300
     )
-    return original_text + "\n\n" + completion.choices[0].message["content"]
+    return completion.choices[0].message.content
+
+async def gpt_add_section(original_text, section_topic, bypass_cache=False):
+    # Весь договор не отправляем: новый пункт пишется по окончанию документа,
+    # а склейка выполняется здесь же, без повтора текста моделью
+    tail = original_text[-SECTION_CONTEXT_CHARS:]
+    section = await _write_section(tail, section_topic, bypass_cache=bypass_cache)
+    return original_text + "\n\n" + section
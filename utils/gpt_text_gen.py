@@ -1,22 +1,28 @@
-import openai
+from utils.gpt import MODEL, get_client, gpt_cached
 
-# Настройки для взаимодействия с OpenAI
-openai.api_key = 'your_openai_api_key'
+def _document_prompt(user_data):
+    return f"Генерируй юридический документ для компании {user_data['company_name']}. Юридический адрес: {user_data.get('clarified_info', 'не указан')}. Согласно законодательству РФ на 2025 год."
 
-# Функция для генерации текста документа
-async def gpt_generate_text(user_data):
-    # Параметры для запроса в OpenAI
-    prompt = f"Генерируй юридический документ для компании {user_data['company_name']}. Юридический адрес: {user_data.get('clarified_info', 'не указан')}. Согласно законодательству РФ на 2025 год."
-    
-    # Отправка запроса к OpenAI
-    response = openai.Completion.create(
-        model="gpt-3.5-turbo",
-        prompt=prompt,
+# Потоковая генерация текста документа: фрагменты отдаются по мере ответа OpenAI,
+# поэтому вызывающий код может показывать прогресс, не дожидаясь конца генерации
+async def gpt_generate_text_stream(user_data):
+    stream = await get_client().chat.completions.create(
+        model=MODEL,
+        messages=[{"role": "user", "content": _document_prompt(user_data)}],
         max_tokens=1500,
-        temperature=0.5
+        temperature=0.5,
+        stream=True
     )
-    
-    return response['choices'][0]['text'].strip()
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# Функция для генерации текста документа
+@gpt_cached("gpt_generate_text", temperature=0.5)
+async def gpt_generate_text(user_data):
+    # Фрагменты копятся в списке и склеиваются один раз
+    chunks = [chunk async for chunk in gpt_generate_text_stream(user_data)]
+    return "".join(chunks).strip()
 
 # Функция для проверки недостающих данных в документе
 async def gpt_check_missing_data(document_text):
@@ -2,14 +2,84 @@
 import gspread
 import os
 import json
+import atexit
+import logging
+import threading
 from oauth2client.service_account import ServiceAccountCredentials
 
+logger = logging.getLogger(__name__)
+
 scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-creds_dict = json.loads(os.getenv('GOOGLE_CREDS_JSON'))
-creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-gs = gspread.authorize(creds)
-sheet = gs.open('ReadyDoc MVP').sheet1
+_sheet = None
+
+# Авторизация и открытие таблицы откладываются до первой записи
+def _get_sheet():
+    global _sheet
+    if _sheet is None:
+        creds_dict = json.loads(os.getenv('GOOGLE_CREDS_JSON'))
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        _sheet = gspread.authorize(creds).open('ReadyDoc MVP').sheet1
+    return _sheet
+
+# Строки копятся в буфере и отправляются одним append_rows раз в FLUSH_INTERVAL секунд.
+# При ошибке пачка возвращается в буфер и повторяется с растущей паузой (до MAX_RETRY_DELAY);
+# буфер ограничен MAX_PENDING_ROWS строками, при переполнении отбрасываются самые старые
+FLUSH_INTERVAL = 2.0
+MAX_RETRY_DELAY = 60.0
+MAX_PENDING_ROWS = 10_000
+_pending_rows = []
+# _lock защищает буфер и состояние таймера, _flush_lock — саму отправку:
+# _get_sheet и append_rows выполняются одним потоком за раз, строки идут по порядку
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+# Единственный таймер отправки: задан от планирования до конца запущенной им отправки,
+# поэтому save_row не создает второй таймер и не сбивает паузу повтора
+_flush_timer = None
+_retry_delay = FLUSH_INTERVAL
+
+def _schedule_flush(delay):
+    # Вызывается под _lock
+    global _flush_timer
+    _flush_timer = threading.Timer(delay, flush_rows)
+    _flush_timer.daemon = True
+    _flush_timer.start()
+
+def flush_rows():
+    global _flush_timer, _retry_delay
+    with _flush_lock:
+        with _lock:
+            rows = _pending_rows[:]
+            _pending_rows.clear()
+        failed = False
+        if rows:
+            try:
+                _get_sheet().append_rows(rows)
+            except Exception:
+                logger.exception("Ошибка записи %s строк в Google Sheets", len(rows))
+                failed = True
+        with _lock:
+            if failed:
+                _pending_rows[:0] = rows
+                overflow = len(_pending_rows) - MAX_PENDING_ROWS
+                if overflow > 0:
+                    del _pending_rows[:overflow]
+                    logger.error("Буфер Google Sheets переполнен, отброшено строк: %s", overflow)
+                _retry_delay = min(_retry_delay * 2, MAX_RETRY_DELAY)
+            elif rows:
+                _retry_delay = FLUSH_INTERVAL
+            # Таймер освобождается только запущенной им отправкой (прямой вызов,
+            # например из atexit, ожидающий таймер не трогает)
+            if _flush_timer is threading.current_thread():
+                _flush_timer = None
+            if _flush_timer is None and _pending_rows:
+                _schedule_flush(_retry_delay)
 
 def save_row(user_id, doc_type, data_dict, mode="auto"):
     row = [str(user_id), doc_type] + list(data_dict.values()) + [mode]
-    sheet.append_row(row)
+    with _lock:
+        _pending_rows.append(row)
+        if _flush_timer is None:
+            _schedule_flush(FLUSH_INTERVAL)
+
+# Не теряем накопленные строки при завершении процесса
+atexit.register(flush_rows)